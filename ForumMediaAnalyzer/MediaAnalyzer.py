@@ -2,20 +2,36 @@ import re
 import cv2
 import json
 import base64
+import hashlib
 import logging
 import requests
 import numpy as np
 from datetime import datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import pytz
 import gridfs
 import pymongo
-from pymongo import MongoClient
+from bson import ObjectId, Binary
+from pymongo import MongoClient, InsertOne, UpdateOne, ReturnDocument
 from pymongo.errors import ServerSelectionTimeoutError as MongoServerSelectionTimeoutError
 
 import imagehash
 from PIL import Image
-from skimage.metrics import structural_similarity
+
+# int.bit_count maps to a single popcount instruction
+# but is only available from python 3.10 onwards
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:
+    def _popcount(n: int):
+        return bin(n).count('1')
+
+
+# processed post as it is kept in memory during a run. The thumbnail and
+# SSIM statistics are None until they are first needed for a comparison
+CachedPost = namedtuple('CachedPost', ['dim', 'thumbnail', 'mean', 'ssim_stats'])
 
 
 class AnalyzeConditionsNotMetException(Exception):
@@ -25,6 +41,46 @@ class AnalyzeConditionsNotMetException(Exception):
     pass
 
 
+class BKTree(object):
+    """
+    Burkhard-Keller tree used to find all hashes within a certain distance of
+    a given hash without having to compute the distance to every stored hash.
+    The distance function must be a metric e.g. the hamming distance
+    """
+
+    def __init__(self, distance_func):
+        self._distance_func = distance_func
+        self._root = None
+
+    def add(self, item, value):
+        # every node is stored as (item, value, children) where the children
+        # are keyed by their distance to the item of the parent node
+        if self._root is None:
+            self._root = (item, value, {})
+            return
+
+        node = self._root
+        while True:
+            d = self._distance_func(item, node[0])
+            if d not in node[2]:
+                node[2][d] = (item, value, {})
+                return
+            node = node[2][d]
+
+    def find(self, item, max_distance: int):
+        # only the subtrees that can contain items within max_distance are
+        # visited because of the triangle inequality
+        found = []
+        nodes = [self._root] if self._root is not None else []
+        while nodes:
+            node_item, value, children = nodes.pop()
+            d = self._distance_func(item, node_item)
+            if d <= max_distance:
+                found.append((d, value))
+            nodes.extend(child for cd, child in children.items() if d - max_distance <= cd <= d + max_distance)
+        return found
+
+
 class MediaAnalyzer(object):
     """
     This class is used to analyze data generated by a MediaScraper object:
@@ -45,13 +101,33 @@ class MediaAnalyzer(object):
 
     MONGO_DEFAULT_URI = "mongodb://localhost:27017"
 
+    # maximum hamming distance between the image hashes of two similar images
+    HASH_CUTOFF = 10
+
+    # all similarity measures are computed on thumbnails of this size
+    THUMBNAIL_SIZE = (128, 128)
+
+    # maximum mean squared error between an image and its repost
+    MSE_THRESHOLD = 2000.00
+
+    # minimum structural similarity between an image and its repost and the
+    # constants used to stabilize the SSIM division for 8 bit images
+    SSIM_THRESHOLD = 0.65
+    SSIM_C1 = (0.01 * 255) ** 2
+    SSIM_C2 = (0.03 * 255) ** 2
+
     def __init__(self, scraper_rest_host: str="http://localhost:5000", log_level: int=logging.DEBUG,
-                 document_retrieval_batch_size: int=5, mongo_uri: str=MONGO_DEFAULT_URI):
-        if re.match(MediaAnalyzer.URL_VALIDATION_REGEX, scraper_rest_host) is None:
+                 document_retrieval_batch_size: int=5, mongo_uri: str=MONGO_DEFAULT_URI, io_workers: int=16):
+        if MediaAnalyzer.URL_VALIDATION_REGEX.match(scraper_rest_host) is None:
             raise ValueError('Invalid scraper_rest_host url: %s' % scraper_rest_host)
 
         self.scraper_rest_host = scraper_rest_host
         self.document_retrieval_batch_size = document_retrieval_batch_size
+        self.io_workers = io_workers
+
+        # set to False once the scraper rest interface is found to ignore
+        # after_id after which documents are retrieved using an offset
+        self._after_id_supported = True
         self.timezone = pytz.timezone('Europe/Berlin')
 
         # create database related objects
@@ -59,6 +135,13 @@ class MediaAnalyzer(object):
         self._mongo_database = self._mongo_client['9GagMedia']
         self.gridfs = gridfs.GridFS(self._mongo_database)
 
+        # CachedPost of every processed post keyed by its _id
+        self._post_cache = {}
+        self._hash_tree = BKTree(self._hamming)
+
+        # _id of the original post for the SHA-1 digest of its media bytes
+        self._sha1_index = {}
+
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(log_level)
         logging_args = {
@@ -68,46 +151,78 @@ class MediaAnalyzer(object):
         }
         logging.basicConfig(**logging_args)
 
-        if not self._mongo_database['Counter'].find_one():
-            self._mongo_database['Counter'].insert_one({'_id': 'OrderNum', 'val': 1})
-
     def _get_tz_date(self):
         return datetime.utcnow().replace(tzinfo=pytz.utc).astimezone(self.timezone)
 
-    @staticmethod
-    def _scale_images(image_one: np.ndarray, image_two: np.ndarray, scale_percent_dif: float=0.02):
-        # Scale the images so that they have the same
-        # dimensions. The bigger image will always be scaled down;
-        # It is considered bigger if contains more pixels i.e width x height
-        if image_one.shape == image_two.shape:
-            return image_one, image_two
-
-        # use aspect ratio to determine if images can be rescaled
-        *_, w1, h1 = cv2.boundingRect(image_one)
-        *_, w2, h2 = cv2.boundingRect(image_two)
-        if abs((float(w1) / h1) - (float(w2) / h2)) >= scale_percent_dif:
-            return None, None
-
-        if sum(image_one.shape[:2]) > sum(image_two.shape[:2]):
-            image_one = cv2.resize(
-                src=image_one,
-                dsize=(image_two.shape[1], image_two.shape[0]),
-                interpolation=cv2.INTER_CUBIC
-            )
-        else:
-            image_two = cv2.resize(
-                src=image_two,
-                dsize=(image_one.shape[1], image_one.shape[0]),
-                interpolation=cv2.INTER_CUBIC
+    def _load_decode(self, post: dict):
+        # return the dimensions of the image of a processed post together
+        # with its thumbnail. The thumbnail is stored on the post itself;
+        # for posts processed before thumbnails were stored the image is
+        # retrieved from GridFS. The socket reads, cv2.imdecode and
+        # cv2.resize all release the GIL so this can be run from multiple
+        # threads at once
+        if post.get('Thumbnail') is not None:
+            buff = np.frombuffer(post['Thumbnail'], dtype=np.uint8)
+            return tuple(post['Dim']), cv2.imdecode(buff, cv2.IMREAD_GRAYSCALE)
+
+        f = self.gridfs.get(post['MediaId'])
+        buff = np.frombuffer(f.read(size=-1), dtype=np.uint8)
+        im = cv2.imdecode(buff, cv2.IMREAD_GRAYSCALE)
+        return im.shape, self._thumbnail(im)
+
+    def _get_thumbnail(self, post_id: ObjectId):
+        # thumbnails of posts that were cached from their stored hash and
+        # mean are only retrieved once they are needed for a comparison
+        cached = self._post_cache[post_id]
+        if cached.thumbnail is None:
+            post = self._mongo_database['Posts'].find_one(
+                {'_id': post_id},
+                projection={'Dim': 1, 'MediaId': 1, 'Thumbnail': 1}
             )
-        return image_one, image_two
+            _, thumb = self._load_decode(post)
+            cached = self._post_cache[post_id] = cached._replace(thumbnail=thumb)
+        return cached.thumbnail
+
+    def _get_ssim_stats(self, post_id: ObjectId):
+        # the local statistics of a processed post are computed the first
+        # time it is compared using the structural similarity measure and
+        # are then reused for every following comparison
+        cached = self._post_cache[post_id]
+        if cached.ssim_stats is None:
+            ssim_stats = self._ssim_stats(self._get_thumbnail(post_id))
+            cached = self._post_cache[post_id] = self._post_cache[post_id]._replace(ssim_stats=ssim_stats)
+        return cached.ssim_stats
+
+    @staticmethod
+    def _thumbnail(image: np.ndarray):
+        # Scale the image down to a fixed size so that all images have
+        # the same dimensions and the similarity measures do not have
+        # to process every pixel of the original image. The pixels are
+        # sampled instead of averaged; averaging smooths out differences
+        # in text which lowers the mse far below the MSE_THRESHOLD that
+        # is meant to catch them, while the mse of sampled pixels is an
+        # estimate of the mse of the original images
+        return cv2.resize(
+            src=image,
+            dsize=MediaAnalyzer.THUMBNAIL_SIZE,
+            interpolation=cv2.INTER_NEAREST
+        )
+
+    @staticmethod
+    def _same_aspect_ratio(dim_one: tuple, dim_two: tuple, scale_percent_dif: float=0.02):
+        # use aspect ratio of the original images to determine if their
+        # thumbnails can be compared. Thumbnails of images with a different
+        # aspect ratio are stretched differently
+        h1, w1 = dim_one[:2]
+        h2, w2 = dim_two[:2]
+        return abs((float(w1) / h1) - (float(w2) / h2)) < scale_percent_dif
 
     @staticmethod
     def _mse(image_one: np.ndarray, image_two: np.ndarray):
         # the 'Mean Squared Error' between the two images is the
         # sum of the squared difference between the two images;
         # NOTE: the two images must have the same dimension
-        err = np.sum((image_one.astype("float") - image_two.astype("float")) ** 2)
+        err = cv2.norm(image_one, image_two, cv2.NORM_L2SQR)
         err /= float(image_one.shape[0] * image_one.shape[1])
 
         # return the MSE, the lower the error, the more "similar"
@@ -115,19 +230,61 @@ class MediaAnalyzer(object):
         return err
 
     @staticmethod
-    def _img_hash(image_one: np.ndarray, image_two: np.ndarray, func=imagehash.average_hash, cutoff: int=10):
-        # Use an image hashing algorithm to check for similarity between images
-        # Calculate the hashes of both images using one of the functions from
-        # the https://github.com/JohannesBuchner/imagehash project and subtract
-        # them from each other. A cutoff can be specified to account for
-        # little discrepancies
-        h1 = func(Image.fromarray(image_one))
-        h2 = func(Image.fromarray(image_two))
-        s = (h1 - h2) - cutoff
-
-        # return the similarity between images where the closer to 0 the better.
-        # taking into account the specified cutoff where s can not be a negative number
-        return int((abs(s)+s)/2)
+    def _ssim_stats(image: np.ndarray):
+        # the local means and variances of an image using the 11x11 gaussian
+        # window with sigma 1.5 described by Wang et al. These only depend
+        # on a single image so they are computed once per image instead of
+        # once for every pair of images that is compared
+        i = image.astype(np.float32)
+        mu = cv2.GaussianBlur(i, (11, 11), 1.5)
+        sigma_2 = cv2.GaussianBlur(i * i, (11, 11), 1.5) - mu * mu
+        return i, mu, sigma_2
+
+    @staticmethod
+    def _ssim(stats_one: tuple, stats_two: tuple):
+        # the 'Structural Similarity Index' compares the local means, variances
+        # and covariance of the two images as returned by _ssim_stats. The
+        # constants stabilize the division and are based on the dynamic
+        # range of 8 bit images
+        # NOTE: the two images must have the same dimension
+        c1 = MediaAnalyzer.SSIM_C1
+        c2 = MediaAnalyzer.SSIM_C2
+
+        i1, mu1, sigma1_2 = stats_one
+        i2, mu2, sigma2_2 = stats_two
+        mu1_mu2 = mu1 * mu2
+        sigma12 = cv2.GaussianBlur(i1 * i2, (11, 11), 1.5) - mu1_mu2
+
+        ssim_map = ((2 * mu1_mu2 + c1) * (2 * sigma12 + c2)) / ((mu1 * mu1 + mu2 * mu2 + c1) * (sigma1_2 + sigma2_2 + c2))
+
+        # return the mean SSIM where 1 means the images are identical
+        return float(ssim_map.mean())
+
+    @staticmethod
+    def _mean(image: np.ndarray):
+        # the global mean of an image in a single pass
+        return float(cv2.mean(image)[0])
+
+    @staticmethod
+    def _pack_hash(image: np.ndarray, func=imagehash.average_hash):
+        # Calculate the hash of an image using one of the functions from
+        # the https://github.com/JohannesBuchner/imagehash project and pack
+        # the 8x8 boolean array into a single 64 bit integer so hashes can
+        # be compared using a xor and a popcount
+        h = func(Image.fromarray(image))
+        return int(np.packbits(h.hash.flatten()).view('>u8')[0])
+
+    @staticmethod
+    def _int64(packed_hash: int):
+        # BSON only supports signed 64 bit integers so packed hashes are stored
+        # in two's complement. Masking with 0xFFFFFFFFFFFFFFFF reverses this
+        return packed_hash - (1 << 64) if packed_hash >= (1 << 63) else packed_hash
+
+    @staticmethod
+    def _hamming(hash_one: int, hash_two: int):
+        # the hamming distance between two packed hashes is the
+        # number of bits that differ between them
+        return _popcount(hash_one ^ hash_two)
 
     def run(self):
         try:
@@ -137,11 +294,14 @@ class MediaAnalyzer(object):
             """
             r = requests.get(
                 url="%s/query" % self.scraper_rest_host,
-                params={'limit': 1, 'offset': 0}
+                params={'limit': 1}
             )
             r.raise_for_status()
             self._mongo_client.server_info()
 
+            # creating an index that already exists is a no-op
+            self._mongo_database['Posts'].create_index([('RunId', pymongo.DESCENDING), ('OrderNum', pymongo.ASCENDING)])
+
             """
             Start processing. If posts have already been processed, use the ArticleId of the 
             last processed article to determine when to stop retrieving more data. Then use 
@@ -150,13 +310,74 @@ class MediaAnalyzer(object):
             - mean squared error
             - structural similarity measure
             """
-            last_article = self._mongo_database['Posts'].find_one(sort=[("OrderNum", pymongo.ASCENDING)])
+            # the scraper returns the newest articles first so the newest processed
+            # article is the first post (lowest OrderNum) of the most recent run
+            last_article = self._mongo_database['Posts'].find_one(
+                sort=[("RunId", pymongo.DESCENDING), ("OrderNum", pymongo.ASCENDING)],
+                projection={'ArticleId': 1}
+            )
             run = self._mongo_database['Runs'].insert_one({
                 'StartProcessTime': self._get_tz_date(),
                 'EndProcessTime': None,
                 'PostsProcessed': 0,
                 'BatchesProcessed': 0
             })
+
+            # cache every processed post once per run so the comparison loop
+            # below never has to go back to GridFS or cv2.imdecode. The
+            # hashes are indexed in a BK-tree so only posts with a similar
+            # hash have to be compared using the more expensive measures
+            self._post_cache = {}
+            self._hash_tree = BKTree(self._hamming)
+            self._sha1_index = {}
+            # reposts are never used as a match so only the original posts are
+            # retrieved, together with just the fields needed for the comparison
+            processed_posts = {pp['_id']: pp for pp in self._mongo_database['Posts'].find(
+                {'IsOriginal': True},
+                projection={'_id': 1, 'ArticleId': 1, 'Dim': 1, 'MediaId': 1, 'Sha1': 1, 'Hash': 1, 'Mean': 1}
+            )}
+            legacy_ids = []
+            for pp in processed_posts.values():
+                if pp.get('Sha1') is not None:
+                    self._sha1_index.setdefault(pp['Sha1'], pp['_id'])
+                if pp.get('Hash') is None:
+                    legacy_ids.append(pp['_id'])
+                    continue
+                im1_hash = pp['Hash'] & 0xFFFFFFFFFFFFFFFF
+                self._post_cache[pp['_id']] = CachedPost(dim=tuple(pp['Dim']), thumbnail=None, mean=pp['Mean'], ssim_stats=None)
+                self._hash_tree.add(im1_hash, pp['_id'])
+
+            # posts processed before the hash and mean were stored
+            # have to be decoded once. Their thumbnail is retrieved separately
+            # so posts that already have one are not read from GridFS. The
+            # results are written back so the next run can use the stored values
+            legacy_posts = []
+            if legacy_ids:
+                legacy_posts = list(self._mongo_database['Posts'].find(
+                    {'_id': {'$in': legacy_ids}},
+                    projection={'_id': 1, 'Dim': 1, 'MediaId': 1, 'Thumbnail': 1}
+                ))
+            legacy_ops = []
+            with ThreadPoolExecutor(max_workers=self.io_workers) as executor:
+                images = executor.map(self._load_decode, legacy_posts)
+                for pp, (im1_dim, im1_thumb) in zip(legacy_posts, images):
+                    im1_hash = self._pack_hash(im1_thumb)
+                    im1_mean = self._mean(im1_thumb)
+                    self._post_cache[pp['_id']] = CachedPost(dim=im1_dim, thumbnail=im1_thumb, mean=im1_mean, ssim_stats=None)
+                    self._hash_tree.add(im1_hash, pp['_id'])
+                    legacy_ops.append(UpdateOne({'_id': pp['_id']}, {'$set': {
+                        'Thumbnail': Binary(cv2.imencode('.png', im1_thumb)[1].tobytes()),
+                        'Hash': self._int64(im1_hash),
+                        'Mean': im1_mean
+                    }}))
+            if legacy_ops:
+                self._mongo_database['Posts'].bulk_write(legacy_ops, ordered=False)
+
+            # documents are retrieved using the _id of the last document of the
+            # previous batch instead of an offset so the scraper rest interface
+            # does not have to skip over all previously retrieved documents. The
+            # offset is kept as well for scraper rest interfaces without after_id
+            last_seen_id = None
             request_offset = 0
             final_batch = False
             last_article_found = False
@@ -164,18 +385,28 @@ class MediaAnalyzer(object):
             batches_processed = 0
 
             while True:
-                resp = requests.get(url="%s/query" % self.scraper_rest_host, params={
-                    'limit': self.document_retrieval_batch_size,
-                    'offset': request_offset
-                })
+                params = {'limit': self.document_retrieval_batch_size}
+                if self._after_id_supported and last_seen_id is not None:
+                    params['after_id'] = last_seen_id
+                else:
+                    params['offset'] = request_offset
+                resp = requests.get(url="%s/query" % self.scraper_rest_host, params=params)
                 resp.raise_for_status()
                 data = resp.json()
-                self.logger.debug('%s: Received new batch of data at %s using offset %d and limit %d' % (
-                    str(run.inserted_id), self._get_tz_date().strftime("%Y-%m-%d %H:%M:%S"), request_offset, self.document_retrieval_batch_size))
+                if 'after_id' in params and len(data['documents']) != 0 \
+                        and data['documents'][-1]['_id'] == last_seen_id:
+                    # the scraper rest interface ignored after_id and returned the
+                    # previous batch again. Retrieve the batch again using the offset
+                    self.logger.warning('%s: %s does not support after_id. Using offset %d instead' % (
+                        str(run.inserted_id), self.scraper_rest_host, request_offset))
+                    self._after_id_supported = False
+                    continue
+                self.logger.debug('%s: Received new batch of data at %s after id %s using limit %d' % (
+                    str(run.inserted_id), self._get_tz_date().strftime("%Y-%m-%d %H:%M:%S"), str(last_seen_id), self.document_retrieval_batch_size))
 
                 if len(data['documents']) == 0:
-                    self.logger.debug('%s: No more documents returned by %s using offset %d and limit %d' % (
-                        str(run.inserted_id), self.scraper_rest_host, request_offset, self.document_retrieval_batch_size))
+                    self.logger.debug('%s: No more documents returned by %s after id %s using limit %d' % (
+                        str(run.inserted_id), self.scraper_rest_host, str(last_seen_id), self.document_retrieval_batch_size))
                     self.logger.info('%s: No more documents found. Finished %d batches' % (str(run.inserted_id), batches_processed))
                     break
 
@@ -184,104 +415,170 @@ class MediaAnalyzer(object):
                         str(run.inserted_id), self.scraper_rest_host))
                     final_batch = True
 
-                if len([doc for doc in data['documents'] if len(doc['Posts']) == 0]) == len(data['documents']):
-                    self.logger.debug('%s: No posts found in documents at offset %d with limit %d' % (
-                        str(run.inserted_id), request_offset, self.document_retrieval_batch_size))
+                docs_with_posts = [doc for doc in data['documents'] if doc['Posts']]
+                if not docs_with_posts:
+                    self.logger.debug('%s: No posts found in documents after id %s with limit %d' % (
+                        str(run.inserted_id), str(last_seen_id), self.document_retrieval_batch_size))
                     self.logger.info('%s: No posts found in batch. Retrieving next batch' % str(run.inserted_id))
-                    request_offset += self.document_retrieval_batch_size
+                    last_seen_id = data['documents'][-1]['_id']
+                    request_offset += len(data['documents'])
                     batches_processed += 1
                     continue
 
-                for doc in [doc for doc in data['documents'] if len(doc['Posts']) != 0]:
+                # reserve an order number for every post in the batch with a single
+                # atomic increment and write all changes to the Posts collection
+                # in one bulk operation once the batch has been processed. The
+                # counter holds the last reserved order number and is created
+                # by the upsert the first time a batch is processed
+                n_new = sum(len(doc['Posts']) for doc in docs_with_posts)
+                order_num = self._mongo_database['Counter'].find_one_and_update(
+                    {'_id': 'OrderNum'},
+                    {'$inc': {'val': n_new}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )['val'] - n_new + 1
+                post_ops = []
+
+                for doc in docs_with_posts:
                     if last_article:
                         if last_article['ArticleId'] == doc['StartPostId'] or last_article_found:
-                            self.logger.debug('%s: Last article %s found at offset %d with limit %d' % (
-                                str(run.inserted_id), str(last_article['ArticleId']), request_offset, self.document_retrieval_batch_size))
+                            self.logger.debug('%s: Last article %s found after id %s with limit %d' % (
+                                str(run.inserted_id), str(last_article['ArticleId']), str(last_seen_id), self.document_retrieval_batch_size))
                             final_batch = True
                             break
 
                     self.logger.info('%s: %d posts found for processing in document %s' % (
                         str(run.inserted_id), len(doc['Posts']), doc['_id']))
-                    processed_posts = self._mongo_database['Posts'].find({})
 
                     for post in doc['Posts']:
                         if last_article:
                             if last_article['ArticleId'] == post['ArticleId']:
-                                self.logger.debug('%s: Last article %s found at offset %d with limit %d' % (
-                                    str(run.inserted_id), str(last_article['ArticleId']), request_offset, self.document_retrieval_batch_size))
+                                self.logger.debug('%s: Last article %s found after id %s with limit %d' % (
+                                    str(run.inserted_id), str(last_article['ArticleId']), str(last_seen_id), self.document_retrieval_batch_size))
                                 last_article_found = True
                                 break
 
-                        im_s = str(post['MediaData'])
-                        im_b = base64.b64decode(im_s.encode('utf-8'))
-                        im_buff = np.asarray(bytearray(im_b), dtype=np.uint8)
-                        im = cv2.imdecode(im_buff, cv2.IMREAD_GRAYSCALE)
+                        im_b = base64.b64decode(post['MediaData'])
+                        im_sha1 = hashlib.sha1(im_b).digest()
                         media_id = self.gridfs.put(im_b)
                         md = {
+                            "_id": ObjectId(),
+                            "OrderNum": order_num,
                             "ArticleId": str(post['ArticleId']),
                             "RunId": run.inserted_id,
                             "PostProcessedTime": self._get_tz_date(),
-                            "Dim": im.shape,
                             "MediaId": media_id,
+                            "Sha1": Binary(im_sha1),
                             "IsOriginal": True,
                             "RepostOff": None,
                             "Reposts": []
                         }
 
-                        for pp in processed_posts:
+                        original_id = self._sha1_index.get(im_sha1)
+                        if original_id is not None and processed_posts[original_id]['ArticleId'] != md['ArticleId']:
+                            # the exact same media has already been processed so
+                            # there is no need to decode and compare it at all
+                            md.update({
+                                "Dim": self._post_cache[original_id].dim,
+                                "IsOriginal": False,
+                                "RepostOff": original_id,
+                                "Reposts": None
+                            })
+                            post_ops.append(UpdateOne({"_id": original_id}, {"$push": {"Reposts": {
+                                "ArticleId": md['ArticleId'],
+                                "mse": 0.0,
+                                "ssim": 1.0,
+                                "hs": 0,
+                                "certainty": 1
+                            }}}))
+                            post_ops.append(InsertOne(md))
+                            order_num += 1
+                            posts_processed += 1
+                            continue
+
+                        im_buff = np.frombuffer(im_b, dtype=np.uint8)
+                        im = cv2.imdecode(im_buff, cv2.IMREAD_GRAYSCALE)
+                        im_thumb = self._thumbnail(im)
+                        im_hash = self._pack_hash(im_thumb)
+                        im_mean = self._mean(im_thumb)
+                        im_ssim_stats = None
+                        md.update({
+                            "Dim": im.shape,
+                            "Thumbnail": Binary(cv2.imencode('.png', im_thumb)[1].tobytes()),
+                            "Hash": self._int64(im_hash),
+                            "Mean": im_mean
+                        })
+
+                        # The hash similarity will determine if an image is even close to being
+                        # similar to the processed image so only posts whose hash is within
+                        # HASH_CUTOFF of the processed image are considered. The very sensitive
+                        # mse measure makes sure that its not a meme that is posted with the same
+                        # background but with different text. The structural similarity measure
+                        # will then decide if this is actually correct. The measures are ordered
+                        # from cheapest to most expensive so every measure is only computed when
+                        # still needed
+                        for hs, pp_id in self._hash_tree.find(im_hash, self.HASH_CUTOFF):
+                            pp = processed_posts[pp_id]
                             if post['ArticleId'] == pp['ArticleId']:
                                 # duplicates will always be exactly the same
                                 # solution to a bug in the MediaScraper...
                                 continue
 
-                            f = self.gridfs.get(pp['MediaId'])
-                            im1_buff = np.asarray(bytearray(f.read(size=-1)), dtype=np.uint8)
-                            im1 = cv2.imdecode(im1_buff, cv2.IMREAD_GRAYSCALE)
-                            im0, im1 = self._scale_images(im, im1)
-                            if not hasattr(im0, "shape"):
+                            cached = self._post_cache[pp['_id']]
+                            if not self._same_aspect_ratio(im.shape, cached.dim):
                                 # images could not be scaled since difference in dimensions
                                 # is too big. Must be unique based on this
                                 continue
 
-                            mse = self._mse(im0, im1)
-                            ss = structural_similarity(im0, im1)
-                            hs = self._img_hash(im0, im1)
-
-                            # The hash similarity will determine if an image is even close to being
-                            # similar to the processed image. The structural similarity measure will
-                            # then decide if this is actually correct. A last check is done to make
-                            # sure that its not a meme that is posted with the same background but
-                            # with different text using the very sensitive mse measure
-                            if hs == 0:
-                                if ss >= 0.65:
-                                    if not mse >= 2000.00 and pp['IsOriginal']:
-                                        # db image seems to be very similar to the processed image
-                                        md.update({"IsOriginal": False, "RepostOff": pp['_id'], "Reposts": None})
-                                        pp['Reposts'].append({
-                                            "ArticleId": md['ArticleId'],
-                                            "mse": mse,
-                                            "ssim": ss,
-                                            "hs": hs,
-                                            "certainty": 1
-                                        })
-                                        self._mongo_database['Posts'].replace_one({"_id": pp['_id']}, pp)
-                                    else:
-                                        # image background might be the same with different text
-                                        continue
-                                else:
-                                    # structural similarity is too far off must be unique
-                                    continue
-                            else:
-                                # images are not similar at all
+                            if (im_mean - cached.mean) ** 2 >= self.MSE_THRESHOLD:
+                                # the mse of two images is never lower than the squared
+                                # difference of their means so the mse check below would
+                                # reject these images without loading the thumbnail
+                                continue
+
+                            im1_thumb = self._get_thumbnail(pp['_id'])
+                            mse = self._mse(im_thumb, im1_thumb)
+                            if mse >= self.MSE_THRESHOLD:
+                                # image background might be the same with different text
                                 continue
 
-                        self._mongo_database['Posts'].insert_one(md)
+                            if im_ssim_stats is None:
+                                im_ssim_stats = self._ssim_stats(im_thumb)
+                            ss = self._ssim(im_ssim_stats, self._get_ssim_stats(pp['_id']))
+                            if ss < self.SSIM_THRESHOLD:
+                                # structural similarity is too far off must be unique
+                                continue
+
+                            # db image seems to be very similar to the processed image
+                            md.update({"IsOriginal": False, "RepostOff": pp['_id'], "Reposts": None})
+                            post_ops.append(UpdateOne({"_id": pp['_id']}, {"$push": {"Reposts": {
+                                "ArticleId": md['ArticleId'],
+                                "mse": mse,
+                                "ssim": ss,
+                                "hs": hs,
+                                "certainty": 1
+                            }}}))
+
+                        post_ops.append(InsertOne(md))
+                        order_num += 1
+                        if md['IsOriginal']:
+                            processed_posts[md['_id']] = md
+                            self._post_cache[md['_id']] = CachedPost(
+                                dim=im.shape, thumbnail=im_thumb, mean=im_mean, ssim_stats=im_ssim_stats
+                            )
+                            self._hash_tree.add(im_hash, md['_id'])
+                            self._sha1_index.setdefault(im_sha1, md['_id'])
                         posts_processed += 1
 
+                if post_ops:
+                    # ordered so reposts of a post from this batch are pushed after its insert
+                    self._mongo_database['Posts'].bulk_write(post_ops, ordered=True)
+
                 if final_batch:
                     break
 
-                request_offset += self.document_retrieval_batch_size
+                last_seen_id = data['documents'][-1]['_id']
+                request_offset += len(data['documents'])
                 batches_processed += 1
 
             self.logger.info('%s: Finished final batch. %d posts processed' % (str(run.inserted_id), posts_processed))